@@ -9,11 +9,23 @@ from getpass import getpass
 import argparse
 import curses
 import json
+import concurrent.futures
+import functools
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
 
 IMAGES_URL = 'https://raw.githubusercontent.com/rothdennis/Proxmox-Templates/refs/heads/main/images.json'
 # Load images configuration
 IMAGES = json.loads(urllib.request.urlopen(IMAGES_URL).read().decode('utf-8'))
 
+STORAGE_CFG = '/etc/pve/storage.cfg'
+SNIPPET_CACHE_FILE = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                                  'proxmox-templates', 'snippets.json')
+CLOUD_INIT_EXTENSIONS = ('.yaml', '.yml')
+
 ### HELPER FUNCTIONS ###
 
 def show_progress(block_num, block_size, total_size):
@@ -127,62 +139,207 @@ def select_storage():
     print('\n-----\n')
     return storage
 
+def parse_storage_cfg():
+    """Parse the Proxmox storage configuration.
+    Returns dict of storage name -> options, or None if the file cannot be read.
+    """
+    try:
+        with open(STORAGE_CFG) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+
+    storages = {}
+    current = None
+    for line in lines:
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        if not line[0].isspace():
+            # Section header: "<type>: <storage>"
+            storage_type, _, name = line.partition(':')
+            current = {'type': storage_type.strip()}
+            storages[name.strip()] = current
+        elif current is not None:
+            # Option line: "<key> <value>" (flags like "disable" have no value)
+            key, _, value = line.strip().partition(' ')
+            current[key] = value.strip()
+    return storages
+
+@functools.lru_cache(maxsize=None)
 def get_snippet_storages():
-    """Get list of storage pools that support snippets content type."""
-    # Get storage status with snippets content type
+    """Get storage pools that support snippets content type.
+    Returns dict of storage name -> snippets directory. The directory is None
+    for storages that are not directory-backed and have to be listed via pvesm.
+    """
+    storage_cfg = parse_storage_cfg()
+    if storage_cfg is not None:
+        node = os.uname().nodename.split('.')[0]
+        storages = {}
+        for storage, options in storage_cfg.items():
+            if 'snippets' not in options.get('content', '').split(','):
+                continue
+            if 'disable' in options:
+                continue
+            if 'nodes' in options and node not in options['nodes'].split(','):
+                continue
+            # Directory-backed storages (dir, nfs, cifs, cephfs, ...) keep snippets
+            # in <path>/snippets. If it is missing (e.g. share not mounted yet),
+            # let pvesm activate the storage and list it instead.
+            snippets_dir = os.path.join(options['path'], 'snippets') if options.get('path') else None
+            if snippets_dir and not os.path.isdir(snippets_dir):
+                snippets_dir = None
+            storages[storage] = snippets_dir
+        return storages
+
+    # Fall back to pvesm if the storage configuration is not readable
     res = subprocess.run(['pvesm', 'status', '--content', 'snippets'], 
                         capture_output=True, text=True)
     output = res.stdout.strip()
     if not output:
-        return []
+        return {}
     
     # Parse output: skip header line, extract first column (storage name)
     lines = output.split('\n')
-    storages = []
+    storages = {}
     for line in lines[1:]:  # Skip header
+        parts = line.split()
+        if parts and parts[0]:
+            storages[parts[0]] = None
+    return storages
+
+def load_snippet_cache():
+    """Load cached snippet directory listings."""
+    try:
+        with open(SNIPPET_CACHE_FILE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+def save_snippet_cache(cache):
+    """Save snippet directory listings. Failing to write the cache is not fatal."""
+    try:
+        os.makedirs(os.path.dirname(SNIPPET_CACHE_FILE), exist_ok=True)
+        temp_file = f'{SNIPPET_CACHE_FILE}.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(cache, f)
+        os.replace(temp_file, SNIPPET_CACHE_FILE)
+    except OSError:
+        pass
+
+def list_snippet_directory(snippets_dir, cache):
+    """List yaml/yml files in a snippets directory.
+    The listing is reused from the cache as long as the directory mtime is unchanged.
+    """
+    try:
+        mtime = os.stat(snippets_dir).st_mtime_ns
+    except OSError:
+        return []
+
+    entry = cache.get(snippets_dir)
+    if isinstance(entry, dict) and entry.get('mtime') == mtime:
+        return entry['files']
+
+    try:
+        with os.scandir(snippets_dir) as entries:
+            files = sorted(e.name for e in entries
+                           if e.is_file() and e.name.endswith(CLOUD_INIT_EXTENSIONS))
+    except OSError:
+        return []
+    cache[snippets_dir] = {'mtime': mtime, 'files': files}
+    return files
+
+def list_snippet_storage(storage, snippets_dir, cache):
+    """List cloud-init files in a single storage as storage:snippets/file.yaml volumes."""
+    if snippets_dir:
+        return [f'{storage}:snippets/{name}' for name in list_snippet_directory(snippets_dir, cache)]
+
+    # Use pvesm list to get snippets in this storage
+    # This returns volumes like: storage:snippets/file.yaml
+    res = subprocess.run(['pvesm', 'list', storage, '--content', 'snippets'], 
+                        capture_output=True, text=True)
+    output = res.stdout.strip()
+    if not output:
+        return []
+    
+    # Parse output: skip header line, extract volume paths
+    # Output format:
+    # Volid                              Format     Type       Size
+    # local:snippets/cloud-init.yaml     snippets   snippets   1234
+    cloud_init_files = []
+    for line in output.split('\n')[1:]:  # Skip header
         parts = line.split()
         if parts:
-            storages.append(parts[0])
-    return [s for s in storages if s]  # Filter out empty strings
+            volume_path = parts[0]  # First column is the volume ID
+            # Validate volume path format: storage:snippets/filename.yaml
+            if ':snippets/' in volume_path and volume_path.endswith(CLOUD_INIT_EXTENSIONS):
+                cloud_init_files.append(volume_path)
+    return cloud_init_files
 
 def get_cloud_init_files():
     """Get list of yaml/yml files from all snippet-enabled storage pools.
     Returns list of volume paths in format storage:snippets/file.yaml
     """
     snippet_storages = get_snippet_storages()
-    cloud_init_files = []
-    
-    for storage in snippet_storages:
-        # Validate storage name contains only allowed characters (alphanumeric, dash, underscore)
-        if not storage or not all(c.isalnum() or c in '-_' for c in storage):
-            continue
+    # Validate storage names contain only allowed characters (alphanumeric, dash, underscore)
+    snippet_storages = {storage: snippets_dir for storage, snippets_dir in snippet_storages.items()
+                        if storage and all(c.isalnum() or c in '-_' for c in storage)}
+    if not snippet_storages:
+        return []
 
-        # Use pvesm list to get snippets in this storage
-        # This returns volumes like: storage:snippets/file.yaml
-        res = subprocess.run(['pvesm', 'list', storage, '--content', 'snippets'], 
-                            capture_output=True, text=True)
-        output = res.stdout.strip()
-        if not output:
-            continue
-        
-        # Parse output: skip header line, extract volume paths
-        # Output format:
-        # Volid                              Format     Type       Size
-        # local:snippets/cloud-init.yaml     snippets   snippets   1234
-        lines = output.split('\n')
-        if len(lines) <= 1:
-            continue  # Only header or empty, no actual content
-        
-        for line in lines[1:]:  # Skip header
-            parts = line.split()
-            if parts:
-                volume_path = parts[0]  # First column is the volume ID
-                # Validate volume path format: storage:snippets/filename.yaml
-                if ':snippets/' in volume_path and volume_path.endswith(('.yaml', '.yml')):
-                    cloud_init_files.append(volume_path)
+    cache = load_snippet_cache()
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        results = executor.map(lambda item: list_snippet_storage(item[0], item[1], cache),
+                               snippet_storages.items())
+        cloud_init_files = [volume for files in results for volume in files]
 
+    # Only keep entries for directories that still exist in the storage configuration
+    save_snippet_cache({d: cache[d] for d in snippet_storages.values() if d in cache})
     return cloud_init_files
 
+def get_cloud_init_file_path(volume):
+    """Resolve a storage:snippets/file.yaml volume to its path on the filesystem."""
+    storage, _, name = volume.partition(':snippets/')
+    snippets_dir = get_snippet_storages().get(storage)
+    if snippets_dir:
+        return os.path.join(snippets_dir, name)
+    res = subprocess.run(['pvesm', 'path', volume], capture_output=True, text=True)
+    return res.stdout.strip() or None
+
+def validate_cloud_init_file(volume):
+    """Check that a cloud-init file has the #cloud-config header and is valid YAML.
+    Returns None if the file is valid, otherwise a description of the problem.
+    """
+    path = get_cloud_init_file_path(volume)
+    if not path:
+        return 'could not resolve file path'
+    try:
+        with open(path, encoding='utf-8') as f:
+            content = f.read()
+    except (OSError, UnicodeDecodeError) as e:
+        return f'could not read file: {e}'
+
+    if content.split('\n', 1)[0].rstrip() != '#cloud-config':
+        return 'first line must be #cloud-config'
+
+    # YAML structure can only be checked if PyYAML is installed
+    if yaml is None:
+        return None
+    try:
+        data = yaml.safe_load(content)
+    except yaml.YAMLError as e:
+        return 'invalid YAML: ' + ' '.join(str(e).split())
+    if data is not None and not isinstance(data, dict):
+        return 'cloud-config must be a YAML mapping'
+    return None
+
+def validate_cloud_init_files(volumes):
+    """Validate cloud-init files concurrently.
+    Returns dict of volume -> error message (None if valid).
+    """
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        return dict(zip(volumes, executor.map(validate_cloud_init_file, volumes)))
+
 def select_cloud_init_method():
     """Ask user whether to input credentials manually or use a cloud-init file."""
     print('Cloud-Init Configuration\n')
@@ -218,15 +375,26 @@ def select_cloud_init_file():
         print('Please add yaml/yml files to a storage pool that supports snippets.')
         sys.exit(1)
     
+    errors = validate_cloud_init_files(cloud_init_files)
+    if all(errors.values()):
+        print('No valid cloud-init files found in snippet-enabled storage pools.\n')
+        for file_path in cloud_init_files:
+            print(f'{file_path}: {errors[file_path]}')
+        print('\nCloud-init files must start with #cloud-config and contain valid YAML.')
+        sys.exit(1)
+    
     print('Select cloud-init file\n')
     for i, file_path in enumerate(cloud_init_files):
-        print(f'{i+1}) {file_path}')
+        invalid_tag = f" (invalid: {errors[file_path]})" if errors[file_path] else ""
+        print(f'{i+1}) {file_path}{invalid_tag}')
     
     while True:
         try:
             choice = int(input('\nEnter choice: ')) - 1
             if 0 <= choice < len(cloud_init_files):
-                break
+                if not errors[cloud_init_files[choice]]:
+                    break
+                print(f'Invalid cloud-init file: {errors[cloud_init_files[choice]]}. Please choose another file.\n')
             else:
                 print('Invalid choice. Please try again.\n')
         except ValueError: